@@ -1,6 +1,9 @@
 import numpy as np
 import calendar
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import date, timedelta
+from scipy.optimize import minimize
 
 
 class FluidProduction:
@@ -23,28 +26,34 @@ class FluidProduction:
         correlation_coeffs
     ):
         k1, k2 = correlation_coeffs
+        index, max_day_prod, first_month = self.decline_start()
+
+        indexes = np.arange(start=index, stop=self.day_fluid_production.size, step=1) - index
+        day_fluid_production_month = max_day_prod * (1 + k1 * k2 * indexes) ** (-1 / k2)
+        deviation = (self.day_fluid_production[index:] - day_fluid_production_month) ** 2
+        self.first_month = first_month
+        self.start_q = max_day_prod
+        self.ind_max = index
+        return np.sum(deviation, axis=-1)
+
+    def decline_start(
+        self
+    ):
         max_day_prod = np.amax(self.day_fluid_production)
-        index = list(np.where(self.day_fluid_production) == max_day_prod)[0][0]
+        index = list(np.where(self.day_fluid_production == max_day_prod))[0][0]
         if index != (self.day_fluid_production.size - 1) and \
             index > (self.day_fluid_production.size - 4) and \
                 self.day_fluid_production.size > 3:
                 max_day_prod = np.amax(self.day_fluid_production[:-3])
                 index = list(np.where(self.day_fluid_production == np.amax(self.day_fluid_production[0:-3])))[0][0]
-        
-        indexes = np.arange(start=index, stop=self.day_fluid_production.size, step=1) - index
-        day_fluid_production_month = max_day_prod * (1 + k1 * k2 * indexes) ** (-1 / k2)
-        deviation = [(self.day_fluid_production[index:] - day_fluid_production_month) ** 2]
-        self.first_month = self.day_fluid_production.size - index + 1
-        self.start_q = max_day_prod
-        self.ind_max = index
-        return np.sum(deviation)
+        first_month = self.day_fluid_production.size - index + 1
+        return index, max_day_prod, first_month
     
     def to_conditions(
         self,
         correlation_coeffs
     ):
         k1, k2 = correlation_coeffs
-        global base_correction
         point = self.considerations[self.well_name][1]
         if np.isnan(point):
             point = 1
@@ -119,9 +128,9 @@ class DesaturationCharacteristic:
         oil_production_model[oil_production_model == -np.inf] = 0
         oil_production_model[oil_production_model == np.inf] = 0
 
-        deviation = [(oil_production_model - self.oil_production) ** 2]
+        deviation = (oil_production_model - self.oil_production) ** 2
 
-        return np.sum(deviation)
+        return np.sum(deviation, axis=-1)
     
     def to_conditions(
         self,
@@ -191,3 +200,357 @@ def fluid_production_profile(
         date_last += timedelta(days=days_in_month)
     
     return q_n, q_liq
+
+
+
+
+def grid_axes_from_bounds(
+    bounds,
+    grid_size=2
+):
+    """
+    построение грубой сетки по границам коэффициентов
+    @param bounds: границы коэффициентов
+    @param grid_size: количество узлов по каждому коэффициенту
+    @return: список одномерных массивов значений для каждого коэффициента (узлы - центры ячеек,
+    для положительных границ, отличающихся более чем в 100 раз, - в логарифмическом масштабе)
+    """
+    if any(low is None or high is None for low, high in bounds):
+        raise ValueError('Для построения сетки по границам все границы коэффициентов должны быть заданы')
+    grid_axes = []
+    for low, high in bounds:
+        if low > 0 and high / low >= 100:
+            edges = np.linspace(np.log(low), np.log(high), grid_size + 1)
+            grid_axes.append(np.exp((edges[:-1] + edges[1:]) / 2))
+        else:
+            edges = np.linspace(low, high, grid_size + 1)
+            grid_axes.append((edges[:-1] + edges[1:]) / 2)
+    return grid_axes
+
+
+def _bounds_arrays(
+    bounds,
+    size
+):
+    if bounds is None:
+        return np.full(size, -np.inf), np.full(size, np.inf)
+    lows = np.array([-np.inf if low is None else low for low, _ in bounds], dtype='float64')
+    highs = np.array([np.inf if high is None else high for _, high in bounds], dtype='float64')
+    return lows, highs
+
+
+def _project_to_conditions(
+    conditions,
+    points,
+    lows,
+    highs,
+    steps=5
+):
+    # несколько векторизованных шагов Ньютона к условию привязки сразу для всех узлов сетки
+    for _ in range(steps):
+        with np.errstate(all='ignore'):
+            binding = np.reshape(conditions(tuple(points.T[:, :, np.newaxis])), (-1,))
+            delta = 1e-7 * np.maximum(1, np.abs(points))
+            gradient = np.stack([
+                (np.reshape(conditions(tuple((points + delta * unit).T[:, :, np.newaxis])), (-1,)) - binding) /
+                delta[:, i]
+                for i, unit in enumerate(np.eye(points.shape[1]))
+            ], axis=-1)
+            step = -(binding / np.sum(gradient ** 2, axis=-1))[:, np.newaxis] * gradient
+        step[~np.isfinite(step)] = 0
+        points = np.clip(points + step, lows, highs)
+    return points
+
+
+def grid_search(
+    objective,
+    grid_axes,
+    bounds=None,
+    n_best=4,
+    conditions=None
+):
+    """
+    оценка целевой функции на грубой сетке параметров одним векторизованным вызовом
+    @param objective: целевая функция (например, FluidProduction.adaptation или DesaturationCharacteristic.solver)
+    @param grid_axes: список одномерных массивов значений для каждого коэффициента
+    @param bounds: границы коэффициентов; узлы сетки за границами прижимаются к ним
+    @param n_best: количество лучших узлов сетки, возвращаемых в качестве начальных приближений
+    @param conditions: условие привязки; если задано, узлы сетки предварительно сдвигаются к нему
+    @return: лучшие узлы сетки (n_best x число коэффициентов); значения целевой функции в них;
+    число вычислений целевой функции
+    """
+    mesh = np.meshgrid(*grid_axes, indexing='ij')
+    points = np.stack([axis.ravel() for axis in mesh], axis=-1).astype('float64')
+    lows, highs = _bounds_arrays(bounds, points.shape[1])
+    points = np.clip(points, lows, highs)
+    if conditions is not None:
+        points = _project_to_conditions(conditions, points, lows, highs)
+    # узлы, совпавшие после прижатия к границам, считаются один раз
+    points = np.unique(points, axis=0)
+
+    # коэффициенты передаются столбцами, чтобы расчёт по всем узлам сетки выполнялся за один вызов
+    with np.errstate(all='ignore'):
+        values = np.asarray(objective(tuple(points.T[:, :, np.newaxis])), dtype='float64')
+    values = np.reshape(values, (-1,))
+    values[~np.isfinite(values)] = np.inf
+    order = np.argsort(values, kind='stable')[:n_best]
+    order = order[np.isfinite(values[order])]
+    if order.size == 0:
+        # на сетке нет ни одной допустимой точки - старт из центра сетки
+        center = np.clip([np.median(axis) for axis in grid_axes], lows, highs)
+        return np.array([center]), np.array([np.inf]), points.shape[0]
+    return points[order], values[order], points.shape[0]
+
+
+def _on_bound(
+    coeffs,
+    bounds
+):
+    lows, highs = _bounds_arrays(bounds, len(coeffs))
+    return bool(np.any(np.isclose(coeffs, lows)) or np.any(np.isclose(coeffs, highs)))
+
+
+def _local_fit(
+    objective,
+    conditions,
+    start,
+    start_value,
+    scale,
+    bounds,
+    options
+):
+    # поиск ведётся в единицах шага сетки, целевая функция нормируется на её значение в узле сетки:
+    # иначе первый шаг SLSQP (с единичной матрицей вместо гессиана) уводит решение на границы
+    norm = start_value if np.isfinite(start_value) and start_value > 0 else 1
+    lows, highs = _bounds_arrays(bounds, len(start))
+    scaled_bounds = [
+        (low if np.isfinite(low) else None, high if np.isfinite(high) else None)
+        for low, high in zip((lows - start) / scale, (highs - start) / scale)
+    ]
+    with np.errstate(all='ignore'):
+        result = minimize(
+            lambda u: objective(start + u * scale) / norm,
+            np.zeros(len(start)),
+            method='SLSQP',
+            bounds=scaled_bounds,
+            constraints={'type': 'eq', 'fun': lambda u: conditions(start + u * scale)},
+            options=options
+        )
+    result.x = start + result.x * scale
+    result.fun = result.fun * norm
+    return result
+
+
+def multi_start_fit(
+    objective,
+    conditions,
+    grid_axes=None,
+    bounds=None,
+    n_starts=4,
+    executor=None,
+    options=None,
+    grid_size=2,
+    basin_tol=1e-3
+):
+    """
+    адаптация коэффициентов с начальным приближением из перебора по сетке;
+    дополнительные старты запускаются, только если решение из лучшего узла сетки
+    не сошлось или остановилось на границе
+    @param objective: целевая функция (сумма квадратов отклонений модели от факта)
+    @param conditions: условие привязки (равенство нулю на последней точке)
+    @param grid_axes: список одномерных массивов значений для каждого коэффициента;
+    если не задан, сетка строится по границам bounds (grid_axes_from_bounds)
+    @param bounds: границы коэффициентов для scipy.optimize.minimize
+    @param n_starts: максимальное количество локальных решений
+    @param executor: пул потоков или процессов для параллельного запуска дополнительных стартов
+    @param options: параметры scipy.optimize.minimize (по умолчанию {'maxiter': 100});
+    ftol задаётся относительно значения целевой функции в узле сетки
+    @param grid_size: количество узлов по каждому коэффициенту при построении сетки по границам
+    @param basin_tol: допуск, в пределах которого решения считаются одним минимумом
+    @return: словарь с найденными коэффициентами и статистикой сходимости
+    """
+    start_time = time.perf_counter()
+    if options is None:
+        options = {'maxiter': 100}
+    if grid_axes is None:
+        if bounds is None:
+            raise ValueError('Необходимо задать сетку grid_axes или границы коэффициентов bounds')
+        grid_axes = grid_axes_from_bounds(bounds, grid_size)
+    grid_axes = [np.asarray(axis, dtype='float64') for axis in grid_axes]
+    scale = np.array([np.ptp(axis) / (axis.size - 1) if axis.size > 1 else 1.0 for axis in grid_axes])
+    scale[scale == 0] = 1.0
+
+    starts, start_values, grid_evaluations = grid_search(
+        objective, grid_axes, bounds, n_best=n_starts, conditions=conditions
+    )
+
+    results = [_local_fit(objective, conditions, starts[0], start_values[0], scale, bounds, options)]
+    if not results[0].success or _on_bound(results[0].x, bounds):
+        tasks = [
+            (objective, conditions, start, start_value, scale, bounds, options)
+            for start, start_value in zip(starts[1:], start_values[1:])
+        ]
+        if executor is None:
+            results += [_local_fit(*task) for task in tasks]
+        elif tasks:
+            results += list(executor.map(_local_fit, *zip(*tasks)))
+
+    local_evaluations = sum(result.nfev for result in results)
+    converged = [result for result in results if result.success and np.isfinite(result.fun)]
+    # решения, сошедшиеся в один и тот же минимум, учитываются один раз
+    basins = []
+    for result in converged:
+        if not any(np.allclose(result.x, basin.x, rtol=basin_tol, atol=basin_tol) for basin in basins):
+            basins.append(result)
+    # лучшим считается решение с минимальным отклонением среди сошедшихся, иначе среди всех
+    candidates = basins if basins else results
+    best = min(candidates, key=lambda result: result.fun if np.isfinite(result.fun) else np.inf)
+
+    return {
+        'coeffs': best.x,
+        'deviation': float(best.fun),
+        'binding': float(np.reshape(conditions(best.x), (-1,))[0]),
+        'success': bool(best.success),
+        'message': best.message,
+        'starts': len(results),
+        'converged_starts': len(converged),
+        'basins': len(basins),
+        'grid_evaluations': grid_evaluations,
+        'local_evaluations': int(local_evaluations),
+        'total_evaluations': int(grid_evaluations + local_evaluations),
+        'fit_time': time.perf_counter() - start_time
+    }
+
+
+def _fit_model(
+    model,
+    grid_axes,
+    bounds,
+    n_starts,
+    options,
+    grid_size
+):
+    if isinstance(model, FluidProduction):
+        result = multi_start_fit(
+            model.adaptation, model.to_conditions, grid_axes, bounds, n_starts,
+            options=options, grid_size=grid_size
+        )
+        # параметры начала падения добычи не зависят от коэффициентов и возвращаются вместе с результатом,
+        # поэтому результат не зависит от того, в потоке или в процессе выполнялась адаптация
+        result['ind_max'], result['start_q'], result['first_month'] = model.decline_start()
+        return result
+    return multi_start_fit(
+        model.solver, model.to_conditions, grid_axes, bounds, n_starts,
+        options=options, grid_size=grid_size
+    )
+
+
+def fit_wells(
+    models,
+    grid_axes=None,
+    bounds=None,
+    n_starts=4,
+    max_workers=None,
+    use_processes=False,
+    options=None,
+    grid_size=2
+):
+    """
+    адаптация однотипных моделей (только FluidProduction или только DesaturationCharacteristic)
+    по всем скважинам в пуле потоков или процессов
+    @param models: список моделей по скважинам
+    @param grid_axes: список одномерных массивов значений для каждого коэффициента
+    @param bounds: границы коэффициентов
+    @param n_starts: максимальное количество локальных решений для каждой скважины
+    @param max_workers: количество потоков или процессов
+    @param use_processes: True - пул процессов, False - пул потоков
+    @param options: параметры scipy.optimize.minimize (по умолчанию {'maxiter': 100})
+    @param grid_size: количество узлов по каждому коэффициенту при построении сетки по границам
+    @return: словарь {№ скважины: результат multi_start_fit}
+    """
+    if len({type(model) for model in models}) > 1:
+        raise ValueError('Модели разных типов имеют разное число коэффициентов и адаптируются отдельными вызовами')
+    well_names = [model.well_name for model in models]
+    if len(set(well_names)) != len(well_names):
+        raise ValueError('Для каждой скважины допускается только одна модель')
+
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_fit_model, model, grid_axes, bounds, n_starts, options, grid_size)
+            for model in models
+        ]
+        results = [future.result() for future in futures]
+
+    return dict(zip(well_names, results))
+
+
+if __name__ == "__main__":
+    # самопроверка на синтетических данных
+    rng = np.random.default_rng(0)
+    considerations = {str(i): [np.nan, np.nan] for i in range(8)}
+    fluid_bounds = [(1e-4, 1), (1e-3, 5)]
+    desaturation_bounds = [(0.1, 10), (0.1, 10), (0.01, 50)]
+
+    fluid_models = []
+    desaturation_models = []
+    for well_name in considerations:
+        k1, k2 = rng.uniform(0.01, 0.3), rng.uniform(0.1, 2)
+        fluid = 100 * (1 + k1 * k2 * np.arange(30)) ** (-1 / k2) + rng.normal(0, 1, 30)
+        fluid_models.append(FluidProduction(fluid, considerations, well_name))
+
+        corey_oil, corey_water, mef = rng.uniform(1, 4), rng.uniform(1, 4), rng.uniform(0.5, 5)
+        liq = rng.uniform(50, 80, 36)
+        irr = rng.uniform(3, 10)
+        oil = []
+        for q_liq in liq:
+            rf = np.sum(oil) / irr / 1e3
+            oil.append(q_liq * (1 - rf) ** corey_oil / ((1 - rf) ** corey_oil + mef * rf * corey_water))
+        oil = np.array(oil) * (1 + rng.normal(0, 0.02, 36))
+        desaturation_models.append(DesaturationCharacteristic(
+            oil, liq, irr, considerations, well_name, True, 1 - oil / liq, np.sum(oil) / irr / 1e3
+        ))
+
+    # векторизованный расчёт совпадает с поточечным
+    for models, objective_name, bounds in [
+        (fluid_models, 'adaptation', fluid_bounds),
+        (desaturation_models, 'solver', desaturation_bounds)
+    ]:
+        points = np.stack([axis.ravel() for axis in np.meshgrid(
+            *grid_axes_from_bounds(bounds, 3), indexing='ij'
+        )], axis=-1)
+        for model in models:
+            objective = getattr(model, objective_name)
+            with np.errstate(all='ignore'):
+                vectorized = objective(tuple(points.T[:, :, np.newaxis]))
+                scalar = [objective(point) for point in points]
+            assert np.allclose(vectorized, scalar, equal_nan=True)
+
+    for models, objective_name, bounds, guess in [
+        (fluid_models, 'adaptation', fluid_bounds, (0.1, 1.0)),
+        (desaturation_models, 'solver', desaturation_bounds, (1, 1, 1))
+    ]:
+        # пул потоков и пул процессов дают одинаковые коэффициенты
+        fits_threads = fit_wells(models, bounds=bounds)
+        fits_processes = fit_wells(models, bounds=bounds, use_processes=True)
+        for well_name in fits_threads:
+            assert np.allclose(fits_threads[well_name]['coeffs'], fits_processes[well_name]['coeffs'])
+
+        # по месторождению вычислений меньше, чем при одном старте из начального приближения
+        single_start_evaluations = 0
+        for model in models:
+            objective = getattr(model, objective_name)
+            with np.errstate(all='ignore'):
+                result = minimize(
+                    objective,
+                    guess,
+                    method='SLSQP',
+                    bounds=bounds,
+                    constraints={'type': 'eq', 'fun': model.to_conditions}
+                )
+            single_start_evaluations += result.nfev
+            assert fits_threads[model.well_name]['deviation'] <= result.fun * 1.001
+        total_evaluations = sum(fit['total_evaluations'] for fit in fits_threads.values())
+        print(objective_name, 'вычислений целевой функции:', total_evaluations,
+              'при одном старте:', single_start_evaluations)
+        assert total_evaluations < single_start_evaluations